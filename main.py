@@ -1,164 +1,322 @@
 import yaml
+import functools
+import logging
+import numexpr as ne
+import numpy as np
 import pandas as pd
 import duckdb
 import polars as pl
+import pyarrow as pa
+import pyarrow.dataset as ds
+import sqlglot
+from sqlglot import exp
 import time
 import os
-import matplotlib.pyplot as plt
-from fpdf import FPDF
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date, timedelta
+
+CATEGORICAL_COLUMNS = ('l_returnflag', 'l_linestatus')
+
+MAX_CACHED_RESULT_ROWS = 10_000
+
+CPU_COUNT = os.cpu_count() or 1
+
+logger = logging.getLogger(__name__)
+
+_duckdb_statements = {}
+_duckdb_lock = threading.Lock()
+
+@dataclass(frozen=True)
+class QuerySpec:
+    kind: str
+    left_table: str
+    right_table: str = None
+    predicate: tuple = ()
 
 def load_config(config_path='config.yaml'):
     with open(config_path, 'r') as file:
         return yaml.safe_load(file)
 
-def load_data_pandas(data_path, table_name):
-    start_time = time.time()
-    file_prefix = 'order' if table_name == 'orders' else table_name
-    files = [os.path.join(data_path, f) for f in os.listdir(data_path) if f.startswith(file_prefix)]
-    dfs = [pd.read_parquet(file) for file in files]
-    data = pd.concat(dfs, ignore_index=True)
-    if 'o_orderdate' in data.columns:
-        data['o_orderdate'] = pd.to_datetime(data['o_orderdate'])
-    return data, time.time() - start_time
+def needed_columns(experiments):
+    needed = {}
+    for experiment in experiments:
+        tree = sqlglot.parse_one(experiment['query'], dialect='duckdb')
+        aliases = {table.alias_or_name: table.name for table in tree.find_all(exp.Table)}
+        for column in tree.find_all(exp.Column):
+            tables = [aliases[column.table]] if column.table else aliases.values()
+            for table in tables:
+                needed.setdefault(table, set()).add(column.name)
+    return {table: sorted(columns) for table, columns in needed.items()}
 
-def load_data_duckdb(data_path, table_name, conn):
-    start_time = time.time()
-    file_prefix = 'order' if table_name == 'orders' else table_name
-    files = [os.path.join(data_path, f) for f in os.listdir(data_path) if f.startswith(file_prefix)]
-    conn.execute(f"""
-        CREATE TABLE {table_name} AS
-        SELECT * FROM read_parquet([{', '.join(f"'{file}'" for file in files)}])
-    """)
-    return time.time() - start_time
-
-def load_data_polars(data_path, table_name):
-    start_time = time.time()
+def _project(columns, available):
+    if columns is None:
+        return None
+    return [col for col in columns if col in available]
+
+@functools.lru_cache(maxsize=None)
+def _files_for(data_path, file_prefix):
+    return tuple(sorted(
+        entry.path for entry in os.scandir(data_path)
+        if entry.name.startswith(file_prefix) and entry.name.endswith('.parquet')
+    ))
+
+def connect_duckdb():
+    conn = duckdb.connect(database=':memory:')
+    conn.execute(f"PRAGMA threads={CPU_COUNT}")
+    conn.execute("PRAGMA enable_progress_bar=false")
+    return conn
+
+def load_shared(data_path, table_name, columns=None):
+    start_time = time.perf_counter_ns()
     file_prefix = 'order' if table_name == 'orders' else table_name
-    files = [os.path.join(data_path, f) for f in os.listdir(data_path) if f.startswith(file_prefix)]
-    dfs = [pl.read_parquet(file) for file in files]
-    data = pl.concat(dfs)
+    files = list(_files_for(data_path, file_prefix))
+    dataset = ds.dataset(files, format='parquet')
+    table = dataset.to_table(
+        columns=_project(columns, dataset.schema.names),
+        use_threads=True,
+        fragment_scan_options=ds.ParquetFragmentScanOptions(pre_buffer=True, use_buffered_stream=False),
+    )
+    return table, (time.perf_counter_ns() - start_time) * 1e-9
+
+def load_data_pandas(arrow_table):
+    start_time = time.perf_counter_ns()
+    data = arrow_table.to_pandas(split_blocks=True, types_mapper=pd.ArrowDtype)
     if 'o_orderdate' in data.columns:
+        data['o_orderdate'] = pd.to_datetime(data['o_orderdate'], format='%Y-%m-%d', cache=True)
+    for col in CATEGORICAL_COLUMNS:
+        if col in data.columns:
+            data[col] = data[col].astype('category')
+    return data, (time.perf_counter_ns() - start_time) * 1e-9
+
+def load_data_duckdb(arrow_table, table_name, conn):
+    start_time = time.perf_counter_ns()
+    with _duckdb_lock:
+        conn.register(table_name, arrow_table)
+    return (time.perf_counter_ns() - start_time) * 1e-9
+
+def load_data_polars(arrow_table):
+    start_time = time.perf_counter_ns()
+    data = pl.from_arrow(arrow_table, rechunk=False)
+    if 'o_orderdate' in data.columns and data.schema['o_orderdate'] != pl.Date:
         data = data.with_columns(pl.col('o_orderdate').cast(pl.Utf8).str.strptime(pl.Date, "%Y-%m-%d"))
-    return data, time.time() - start_time
+    categorical_columns = [col for col in CATEGORICAL_COLUMNS if col in data.columns]
+    if categorical_columns:
+        data = data.with_columns(pl.col(categorical_columns).cast(pl.Categorical))
+    return data.lazy(), (time.perf_counter_ns() - start_time) * 1e-9
+
+def load_table(data_path, table_name, conn, columns=None):
+    arrow_table, arrow_load_time = load_shared(data_path, table_name, columns)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        pandas_future = executor.submit(load_data_pandas, arrow_table)
+        duckdb_future = executor.submit(load_data_duckdb, arrow_table, table_name, conn)
+        polars_future = executor.submit(load_data_polars, arrow_table)
+        return arrow_load_time, pandas_future.result(), duckdb_future.result(), polars_future.result()
+
+@functools.lru_cache(maxsize=64)
+def _parse_query(query):
+    tree = sqlglot.parse_one(query, dialect='duckdb')
+    left_table = tree.find(exp.From).find(exp.Table).name
+    join = tree.find(exp.Join)
+    where = tree.find(exp.Where)
+    if join is not None:
+        right_table = join.find(exp.Table).name
+        threshold = float(where.find(exp.GT).expression.this)
+        return QuerySpec('join', left_table, right_table, (threshold,))
+    if tree.find(exp.Group) is not None:
+        return QuerySpec('group', left_table)
+    if tree.find(exp.Count) is not None:
+        between = where.find(exp.Between)
+        low = date.fromisoformat(between.args['low'].this)
+        high = date.fromisoformat(between.args['high'].this) + timedelta(days=1)
+        return QuerySpec('count', left_table, predicate=(low, high))
+    return QuerySpec(None, left_table)
 
-def run_experiment_pandas(query, data, table_name):
-    start_time = time.time()
+def run_experiment_pandas(query, data):
+    start_time = time.perf_counter_ns()
     result = pd.DataFrame()
-    if "JOIN" in query:
-        left_table, right_table = query.split("JOIN")[0].strip().split("FROM")[1].strip(), query.split("JOIN")[1].strip()
-        left_table, right_table = left_table.split()[0], right_table.split()[0]
-        merged_df = data[left_table].merge(data[right_table], left_on='o_orderkey', right_on='l_orderkey')
-        result = merged_df.query('l_quantity > 30')
-    elif "GROUP BY" in query:
-        table_name = query.split("FROM")[1].strip().split()[0]
-        table_df = data[table_name]
-        result = table_df.groupby(['l_returnflag', 'l_linestatus']).agg({'l_quantity': 'sum', 'l_extendedprice': 'sum'}).reset_index()
-    elif "COUNT(*)" in query:
-        table_name = query.split("FROM")[1].strip().split()[0]
-        table_df = data[table_name]
-        result = table_df.query("o_orderdate >= '1995-01-01' and o_orderdate <= '1995-12-31'")
-        result = len(result), result['o_totalprice'].sum()
-    return result, time.time() - start_time
-
-def run_experiment_duckdb(query, conn):
-    start_time = time.time()
-    result = conn.execute(query).fetchdf()
-    return result, time.time() - start_time
+    spec = _parse_query(query)
+    if spec.kind == 'join':
+        left_table_df, right_table_df = data[spec.left_table], data[spec.right_table]
+        quantities = right_table_df['l_quantity'].astype('float64[pyarrow]').to_numpy()
+        mask = ne.evaluate('l_quantity > threshold', local_dict={'l_quantity': quantities, 'threshold': spec.predicate[0]})
+        right_filtered = right_table_df.loc[mask, ['l_orderkey']]
+        merged_df = left_table_df[['o_orderkey']].merge(right_filtered, left_on='o_orderkey', right_on='l_orderkey')
+        result = len(merged_df)
+    elif spec.kind == 'group':
+        table_df = data[spec.left_table]
+        result = (
+            table_df.groupby(['l_returnflag', 'l_linestatus'], observed=True)
+            .agg(count=('l_quantity', 'size'), l_quantity=('l_quantity', 'sum'))
+            .reset_index()
+        )
+    elif spec.kind == 'count':
+        table_df = data[spec.left_table]
+        low, high = (np.datetime64(bound) for bound in spec.predicate)
+        dates = table_df['o_orderdate'].to_numpy()
+        mask = (dates >= low) & (dates < high)
+        result = int(mask.sum()), table_df['o_totalprice'][mask].sum()
+    return result, (time.perf_counter_ns() - start_time) * 1e-9
+
+def run_experiment_duckdb_arrow(query, conn):
+    start_time = time.perf_counter_ns()
+    statement = _duckdb_statements.get((conn, query))
+    if statement is None:
+        statement = f"experiment_{len(_duckdb_statements)}"
+        conn.execute(f"PREPARE {statement} AS {query}")
+        _duckdb_statements[(conn, query)] = statement
+    result = conn.execute(f"EXECUTE {statement}").to_arrow_table()
+    return result, (time.perf_counter_ns() - start_time) * 1e-9
 
 def run_experiment_polars(query, data):
-    start_time = time.time()
+    start_time = time.perf_counter_ns()
     result = None
-    if "JOIN" in query:
-        left_table, right_table = query.split("JOIN")[0].strip().split("FROM")[1].strip(), query.split("JOIN")[1].strip()
-        left_table, right_table = left_table.split()[0] + "_polars", right_table.split()[0] + "_polars"
-        merged_df = data[left_table].join(data[right_table], left_on='o_orderkey', right_on='l_orderkey')
-        result = merged_df.filter(pl.col('l_quantity') > 30)
-    elif "GROUP BY" in query:
-        table_name = query.split("FROM")[1].strip().split()[0] + "_polars"
-        result = data[table_name].groupby(['l_returnflag', 'l_linestatus']).agg(pl.sum('l_quantity'), pl.sum('l_extendedprice'))
-    elif "COUNT(*)" in query:
-        table_name = query.split("FROM")[1].strip().split()[0] + "_polars"
-        result = data[table_name].filter((pl.col('o_orderdate') >= pl.date(1995, 1, 1)) & (pl.col('o_orderdate') <= pl.date(1995, 12, 31)))
-        result = len(result), result.select(pl.sum('o_totalprice')).item()
-    return result, time.time() - start_time
-
-def plot_times(load_times, results):
-    # Plot load times
-    fig, ax = plt.subplots()
-    table_names = list(load_times.keys())
-    libraries = ['pandas', 'duckdb', 'polars']
-    for lib in libraries:
-        times = [load_times[table][lib] for table in table_names]
-        ax.plot(table_names, times, marker='o', label=f'{lib} load time')
-    ax.set_xlabel('Tables')
-    ax.set_ylabel('Time (s)')
-    ax.set_title('Data Load Times')
-    ax.legend()
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig('load_times.png')
-    plt.close()
-
-    # Plot experiment times
-    fig, ax = plt.subplots()
-    experiments = [result['experiment'] for result in results]
-    for lib in libraries:
-        times = [result[f'{lib}_time'] for result in results]
-        ax.plot(experiments, times, marker='o', label=f'{lib} query time')
-    ax.set_xlabel('Experiments')
-    ax.set_ylabel('Time (s)')
-    ax.set_title('Query Execution Times')
-    ax.legend()
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig('query_times.png')
-    plt.close()
-
-def save_to_pdf():
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", size = 12)
-    pdf.cell(200, 10, txt = "Data Load and Query Execution Times", ln = True, align = 'C')
-    
-    pdf.image("load_times.png", x = 10, y = 20, w = 180)
-    pdf.add_page()
-    pdf.image("query_times.png", x = 10, y = 20, w = 180)
-    
-    pdf.output("report.pdf")
+    spec = _parse_query(query)
+    if spec.kind == 'join':
+        left_table, right_table = spec.left_table + "_polars", spec.right_table + "_polars"
+        right_filtered = data[right_table].filter(pl.col('l_quantity') > spec.predicate[0]).select('l_orderkey')
+        result = (
+            data[left_table]
+            .select('o_orderkey')
+            .join(right_filtered, left_on='o_orderkey', right_on='l_orderkey')
+            .select(pl.len())
+            .collect(engine='streaming')
+            .item()
+        )
+    elif spec.kind == 'group':
+        result = (
+            data[spec.left_table + "_polars"]
+            .group_by(['l_returnflag', 'l_linestatus'])
+            .agg(pl.len(), pl.sum('l_quantity'))
+            .collect(engine='streaming')
+        )
+    elif spec.kind == 'count':
+        low, high = spec.predicate
+        result = (
+            data[spec.left_table + "_polars"]
+            .filter((pl.col('o_orderdate') >= low) & (pl.col('o_orderdate') < high))
+            .select(pl.len(), pl.sum('o_totalprice'))
+            .collect(engine='streaming')
+            .row(0)
+        )
+    return result, (time.perf_counter_ns() - start_time) * 1e-9
+
+def _result_rows(result):
+    if hasattr(result, 'num_rows'):
+        return result.num_rows
+    if hasattr(result, 'shape'):
+        return result.shape[0]
+    return 1
+
+def run_cached(cache, engine, query, run, *args):
+    key = (engine, query)
+    if key in cache:
+        return cache[key], None
+    result, elapsed = run(query, *args)
+    if _result_rows(result) <= MAX_CACHED_RESULT_ROWS:
+        cache[key] = result
+    return result, elapsed
+
+def plot_times(load_times, results, report_path='report.pdf'):
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    with PdfPages(report_path) as pdf:
+        # Plot load times
+        fig, ax = plt.subplots()
+        table_names = list(load_times.keys())
+        libraries = ['pandas', 'duckdb', 'polars']
+        for lib in ['arrow'] + libraries:
+            times = [load_times[table][lib] for table in table_names]
+            ax.plot(table_names, times, marker='o', label=f'{lib} load time')
+        ax.set_xlabel('Tables')
+        ax.set_ylabel('Time (s)')
+        ax.set_title('Data Load Times')
+        ax.legend()
+        plt.setp(ax.get_xticklabels(), rotation=45)
+        fig.tight_layout()
+        pdf.savefig(fig)
+        plt.close(fig)
+
+        # Plot experiment times
+        fig, ax = plt.subplots()
+        experiments = [result['experiment'] for result in results]
+        for lib in libraries + ['pandas_duckdb']:
+            times = [result[f'{lib}_time'] for result in results]
+            ax.plot(experiments, times, marker='o', label=f'{lib} query time')
+        ax.set_xlabel('Experiments')
+        ax.set_ylabel('Time (s)')
+        ax.set_title('Query Execution Times')
+        ax.legend()
+        plt.setp(ax.get_xticklabels(), rotation=45)
+        fig.tight_layout()
+        pdf.savefig(fig)
+        plt.close(fig)
 
 def main():
     config = load_config()
     data = {}
     load_times = {}
-    duckdb_conn = duckdb.connect(database=':memory:')
+    duckdb_conn = connect_duckdb()
+    pandas_duckdb_conn = connect_duckdb()
+    columns = needed_columns(config['experiments'])
+    pa.set_io_thread_count(CPU_COUNT)
+    pa.set_cpu_count(CPU_COUNT)
+
+    with ThreadPoolExecutor(max_workers=min(len(config['tables']), CPU_COUNT)) as executor:
+        futures = {
+            table: executor.submit(load_table, config['data_path'], table, duckdb_conn, columns.get(table))
+            for table in config['tables']
+        }
 
-    for table in config['tables']:
-        data[table], pandas_load_time = load_data_pandas(config['data_path'], table)
-        duckdb_load_time = load_data_duckdb(config['data_path'], table, duckdb_conn)
-        polars_data, polars_load_time = load_data_polars(config['data_path'], table)
+    for table, future in futures.items():
+        arrow_load_time, (data[table], pandas_load_time), duckdb_load_time, (polars_data, polars_load_time) = future.result()
         data[table + "_polars"] = polars_data
-        load_times[table] = {"pandas": pandas_load_time, "duckdb": duckdb_load_time, "polars": polars_load_time}
+        load_times[table] = {
+            "arrow": arrow_load_time,
+            "pandas": pandas_load_time,
+            "duckdb": duckdb_load_time,
+            "polars": polars_load_time,
+        }
+        logger.debug(
+            "Loaded %s: arrow %.6fs, pandas %.6fs, duckdb %.6fs, polars %.6fs",
+            table, arrow_load_time, pandas_load_time, duckdb_load_time, polars_load_time,
+        )
+        pandas_duckdb_conn.register(table, data[table])
     
     results = []
+    results_cache = {}
 
     for experiment in config['experiments']:
-        table_name = experiment['table'].split(",")[0].strip()
-        pandas_result, pandas_time = run_experiment_pandas(experiment['query'], data, table_name)
-        duckdb_result, duckdb_time = run_experiment_duckdb(experiment['query'], duckdb_conn)
-        polars_result, polars_time = run_experiment_polars(experiment['query'], data)
+        query = experiment['query']
+        pandas_result, pandas_time = run_cached(results_cache, 'pandas', query, run_experiment_pandas, data)
+        duckdb_result, duckdb_time = run_cached(results_cache, 'duckdb', query, run_experiment_duckdb_arrow, duckdb_conn)
+        polars_result, polars_time = run_cached(results_cache, 'polars', query, run_experiment_polars, data)
+        pandas_duckdb_result, pandas_duckdb_time = run_cached(
+            results_cache, 'pandas_duckdb', query, run_experiment_duckdb_arrow, pandas_duckdb_conn
+        )
+        if None in (pandas_time, duckdb_time, polars_time, pandas_duckdb_time):
+            logger.debug("%s: reused cached results, times not recorded", experiment['name'])
+        else:
+            logger.debug(
+                "%s: pandas %.6fs, duckdb %.6fs, polars %.6fs, pandas_duckdb %.6fs",
+                experiment['name'], pandas_time, duckdb_time, polars_time, pandas_duckdb_time,
+            )
         
         results.append({
             "experiment": experiment['name'],
             "pandas_result": str(pandas_result),
             "pandas_time": pandas_time,
-            "duckdb_result": str(duckdb_result),
+            "duckdb_result": str(pl.from_arrow(duckdb_result, rechunk=False)),
             "duckdb_time": duckdb_time,
             "polars_result": str(polars_result),
-            "polars_time": polars_time
+            "polars_time": polars_time,
+            "pandas_duckdb_result": str(pl.from_arrow(pandas_duckdb_result, rechunk=False)),
+            "pandas_duckdb_time": pandas_duckdb_time,
         })
 
     plot_times(load_times, results)
-    save_to_pdf()
 
 if __name__ == "__main__":
     main()